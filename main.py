@@ -1,56 +1,174 @@
 # main.py
 import os
+import hmac
+import json
+import time
+import base64
+import hashlib
 import logging
+import secrets
 from typing import Optional
 from dotenv import load_dotenv
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 from fastapi import FastAPI, Request, Form, File, UploadFile, BackgroundTasks, HTTPException
 from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.templating import Jinja2Templates
+from starlette.concurrency import run_in_threadpool
 from starlette.templating import _TemplateResponse
-from contextlib import asynccontextmanager
-from sqlmodel import Session, select
-from sqlalchemy.orm import selectinload
+from contextlib import asynccontextmanager, ExitStack
+from anyio import to_thread
 from urllib.parse import urlencode
+from sqlmodel import Session, select, insert, update, delete, col
+from sqlalchemy import String, literal
+from sqlalchemy.orm import selectinload
 
-from x_automation_studio.models import AIModel, Prompt, TextOutput, Feedback, Domain, PromptType, engine, create_tables, seed_db
-from x_automation_studio.tweet import submit_tweet, handle_tweet_response
-from x_automation_studio.utils import get_temp_dir
-from x_automation_studio.suggestion import get_suggestion, create_output_record, rewrite_prompt, select_random_model
+# Load environment variables before importing the package, which reads
+# some of them (SQL_ECHO, X_USERNAME) at import time
+load_dotenv(override=True)
+
+from x_automation_studio.models import AIModel, Prompt, TextOutput, ImageOutput, Feedback, Domain, PromptType, engine, create_tables, seed_db
+from x_automation_studio.auth import close_http_session
+from x_automation_studio.tweet import submit_tweet_async, handle_tweet_response
+from x_automation_studio.utils import temp_workdir, save_upload
+from x_automation_studio.suggestion import Mode, get_suggestion, create_output_record, rewrite_prompt, select_random_model, invalidate_catalog_cache
 
 # Configure logging
 logger = logging.getLogger("uvicorn.error")
 logger.setLevel(logging.INFO)
 
-# Load environment variables
-load_dotenv(override=True)
+# Tweet posting, media upload and LLM calls each hold a worker thread for a
+# full network round trip, so allow sizing the pool beyond AnyIO's default
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "40"))
+
+# X accepts images up to 5 MB in these formats; reject anything else before
+# touching disk. Each type maps to the extension its upload is saved with.
+ALLOWED_IMAGE_TYPES = {"image/jpeg": ".jpg", "image/png": ".png", "image/gif": ".gif", "image/webp": ".webp"}
+MAX_IMAGE_BYTES = 5 * 1024 * 1024
+
+# Post-redirect flash messages travel in a signed cookie rather than the URL.
+# Set FLASH_SECRET when running several workers so they can verify each other's cookies.
+FLASH_COOKIE = "flash"
+FLASH_SECRET = (os.getenv("FLASH_SECRET") or secrets.token_hex(32)).encode()
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+if WEB_CONCURRENCY > 1 and not os.getenv("FLASH_SECRET"):
+    logger.warning(
+        "FLASH_SECRET is not set but WEB_CONCURRENCY=%d; each worker will sign "
+        "flash cookies with its own random secret, so status messages after "
+        "posting a tweet may be dropped", WEB_CONCURRENCY
+    )
+
+def sign_flash(payload: dict) -> str:
+    """Serialize a flash payload and append an HMAC signature."""
+    data = base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+    signature = hmac.new(FLASH_SECRET, data.encode(), hashlib.sha256).hexdigest()
+    return f"{data}.{signature}"
+
+def read_flash(cookie: Optional[str]) -> dict:
+    """Return the payload of a signed flash cookie, or {} if missing or tampered with."""
+    if not cookie:
+        return {}
+    data, _, signature = cookie.rpartition(".")
+    expected = hmac.new(FLASH_SECRET, data.encode(), hashlib.sha256).hexdigest()
+    # Compare bytes: the cookie is client-controlled and may hold non-ASCII
+    # characters, which compare_digest rejects for str
+    if not hmac.compare_digest(signature.encode(), expected.encode()):
+        return {}
+    try:
+        return json.loads(base64.urlsafe_b64decode(data))
+    except ValueError:
+        return {}
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
     create_tables()
     seed_db()
+    # Compile every template up front so no request pays the parse cost
+    for name in templates.env.list_templates():
+        templates.env.get_template(name)
     yield
+    close_http_session()
+    engine.dispose()
 
 app = FastAPI(lifespan=lifespan)
-templates = Jinja2Templates(directory="templates")
+# Templates don't change while the server runs, so skip the per-render
+# mtime check and keep compiled bytecode across restarts
+templates = Jinja2Templates(env=Environment(
+    loader=FileSystemLoader("templates"),
+    auto_reload=False,
+    cache_size=400,
+    bytecode_cache=FileSystemBytecodeCache(),
+    autoescape=True,
+))
+
+# Statements reused across requests, built once at import
+_STMT_DOMAINS = select(Domain)
+_STMT_DOMAINS_EAGER = select(Domain).options(selectinload(Domain.prompts))  # type: ignore[arg-type]
+_STMT_MODELS = select(AIModel)
+_PROMPT_TYPES = {prompt_type.value: prompt_type for prompt_type in PromptType}
+
+# Domains only change through /settings/add_domain, so the home page can
+# serve them from a short-lived in-process cache
+DOMAINS_TTL = 60
+_domains_cache: Optional[tuple[float, list[Domain]]] = None
+
+def get_domains() -> list[Domain]:
+    """Return all domains, refreshing the cache once it is older than DOMAINS_TTL."""
+    global _domains_cache
+    now = time.monotonic()
+    if _domains_cache is None or now - _domains_cache[0] >= DOMAINS_TTL:
+        with Session(engine) as session:
+            _domains_cache = (now, list(session.exec(_STMT_DOMAINS).all()))
+    return _domains_cache[1]
 
-@app.get("/", response_class=HTMLResponse)
-def show_form(request: Request, message: Optional[str] = None, tweet_link: Optional[str] = None) -> _TemplateResponse:
+def invalidate_domains_cache() -> None:
+    global _domains_cache
+    _domains_cache = None
+
+# Without a flash message the home page depends only on the domain list, so
+# keep the last rendering and reuse it until get_domains returns a new list
+_index_shell: Optional[tuple[list[Domain], str]] = None
+
+def render_index_shell(request: Request) -> str:
+    global _index_shell
+    domains = get_domains()
+    if _index_shell is None or _index_shell[0] is not domains:
+        html = templates.get_template("index.html").render(request=request, domains=domains)
+        _index_shell = (domains, html)
+    return _index_shell[1]
+
+@app.get("/", response_class=HTMLResponse, response_model=None)
+def show_form(request: Request) -> HTMLResponse | _TemplateResponse:
     """
     Serve a basic form (index.html) for posting tweets.
-    Displays messages passed as query parameters.
+    Displays any flash message left by the previous request.
     """
-    with Session(engine) as session:
-        domains = session.exec(select(Domain)).all()
-
-    return templates.TemplateResponse(
+    if FLASH_COOKIE not in request.cookies:
+        return HTMLResponse(render_index_shell(request))
+    flash = read_flash(request.cookies.get(FLASH_COOKIE))
+    response = templates.TemplateResponse(
         "index.html",
         {
             "request": request,
-            "domains": domains,
-            "message": message,
-            "tweet_link": tweet_link
+            "domains": get_domains(),
+            "message": flash.get("message"),
+            "tweet_link": flash.get("tweet_link")
         }
     )
+    response.delete_cookie(FLASH_COOKIE)
+    return response
+
+def flash_redirect(message: Optional[str], tweet_link: Optional[str] = None) -> RedirectResponse:
+    """Redirect to the main page, carrying the results in a short-lived flash cookie."""
+    redirect = RedirectResponse(url="/", status_code=303)
+    redirect.set_cookie(
+        FLASH_COOKIE,
+        sign_flash({"message": message, "tweet_link": tweet_link}),
+        max_age=60,
+        httponly=True,
+        samesite="lax"
+    )
+    return redirect
 
 @app.post("/tweet", response_class=HTMLResponse, response_model=None)
 async def post_tweet(
@@ -64,42 +182,50 @@ async def post_tweet(
     logger.info("Processing tweet request: text='%s', has_image=%s", text, bool(image))
     
     image_path = None
-    if image and image.filename:
-        temp_dir = get_temp_dir()
-        image_path = os.path.join(temp_dir, image.filename)
-        with open(image_path, "wb") as buffer:
-            buffer.write(await image.read())
-        logger.info("Saved uploaded image to: %s", image_path)
+    # The upload lives in its own temp directory, removed once the tweet is sent
+    with ExitStack() as stack:
+        if image and image.filename and image.size:
+            # Rejected images go back to the form like any other posting error
+            if image.content_type not in ALLOWED_IMAGE_TYPES:
+                return flash_redirect("Image must be a JPEG, PNG, GIF or WebP file.")
+            if image.size > MAX_IMAGE_BYTES:
+                return flash_redirect("Image exceeds the 5 MB upload limit.")
+            temp_dir = stack.enter_context(temp_workdir())
+            # Never use the client's filename on disk; the directory is
+            # already private to this request
+            image_path = os.path.join(temp_dir, "upload" + ALLOWED_IMAGE_TYPES[image.content_type])
+            await run_in_threadpool(save_upload, image.file, image_path)
+            await image.close()
+            logger.info("Saved uploaded image to: %s", image_path)
 
-    try:
-        response = submit_tweet(text=text, media_path=image_path)
-        message, tweet_link = handle_tweet_response(response)
-    except Exception as e:
-        logger.error("Error posting tweet: %s", str(e))
-        message = f"Error posting tweet: {str(e)}"
-        tweet_link = None
-
-    # Redirect to the main page with results in query parameters
-    params = {"message": message}
-    if tweet_link:
-        params["tweet_link"] = tweet_link
-    
-    return RedirectResponse(url=f"/?{urlencode(params)}", status_code=303)
+        try:
+            response = await submit_tweet_async(text=text, media_path=image_path)
+            message, tweet_link = handle_tweet_response(response)
+        except Exception as e:
+            logger.error("Error posting tweet: %s", str(e))
+            message = f"Error posting tweet: {str(e)}"
+            tweet_link = None
+
+    return flash_redirect(message, tweet_link)
 
 
 # --- All other endpoints remain the same ---
 # /suggestions, /feedback, /settings/*
 
+def _suggest_and_record(context: str, mode: Mode, domain_id: int | str) -> tuple[dict, int]:
+    # One threadpool hop for generation and the record insert; the template needs the new id
+    suggestion = get_suggestion(context, mode, domain_id=domain_id)
+    return suggestion, create_output_record(suggestion)
+
 @app.get("/suggestions", response_class=HTMLResponse)
 async def get_tweet_suggestion(
     request: Request,
-    background_tasks: BackgroundTasks,
     context: str = "",
-    mode: str = "weighted",
+    mode: Mode = Mode.WEIGHTED,
     domain_id: int | str = ""
 ) -> _TemplateResponse:
-    suggestion: dict = get_suggestion(context, mode, domain_id=domain_id)
-    textoutput_id = create_output_record(suggestion)
+    # The DB and LLM calls are blocking, so keep them off the event loop
+    suggestion, textoutput_id = await run_in_threadpool(_suggest_and_record, context, mode, domain_id)
     return templates.TemplateResponse(
         "suggestion.html",
         {
@@ -109,22 +235,39 @@ async def get_tweet_suggestion(
         }
     )
 
+def _write_feedback(textoutput_id: int, score: int, comment: Optional[str]) -> None:
+    # INSERT ... SELECT only writes when the output exists, in one statement
+    # instead of loading the output and its feedback list first
+    source = select(literal(score), literal(comment, String), col(TextOutput.id)).where(col(TextOutput.id) == textoutput_id)
+    with Session(engine) as session:
+        inserted = session.execute(
+            insert(Feedback)
+            .from_select(["score", "comment", "textoutput_id"], source)
+            .returning(col(Feedback.id))
+        ).first()
+        session.commit()
+    if inserted is None:
+        logger.warning("Feedback dropped: output record %s not found", textoutput_id)
+
 @app.post("/feedback", response_class=HTMLResponse)
-def submit_feedback(
+async def submit_feedback(
     request: Request,
+    background_tasks: BackgroundTasks,
     textoutput_id: int = Form(...),
     score: int = Form(...),
     comment: Optional[str] = Form(None)
 ) -> str:
-    with Session(engine) as session:
-        output = session.get(TextOutput, textoutput_id)
-        if output is None:
-            return "Feedback submission failed: output record not found."
-        output.feedback.append(Feedback(score=score, comment=comment))
-        session.add(output)
-        session.commit()
+    # Acknowledge immediately; the insert runs after the response is sent
+    background_tasks.add_task(_write_feedback, textoutput_id, score, comment)
     return "<div class='alert alert-success'>Feedback recorded. Thank you!</div>"
 
+def redirect_to_settings(domain_id: Optional[int] = None, prompt_type: Optional[str] = None) -> RedirectResponse:
+    """Redirect back to the settings page, re-expanding the domain that was edited."""
+    if domain_id is None:
+        return RedirectResponse(url="/settings", status_code=303)
+    params = {"expanded_domain_id": domain_id, "prompt_type": prompt_type or PromptType.TEXT.value}
+    return RedirectResponse(url=f"/settings?{urlencode(params)}", status_code=303)
+
 @app.get("/settings", response_class=HTMLResponse)
 def settings_page(
     request: Request,
@@ -132,11 +275,10 @@ def settings_page(
     prompt_type: Optional[str] = "text"
 ) -> _TemplateResponse:
     with Session(engine) as session:
-        models = session.exec(select(AIModel)).all()
-        domains = session.exec(select(Domain).options(selectinload(Domain.prompts))).all()
-        prompts = session.exec(select(Prompt)).all()
+        models = session.exec(_STMT_MODELS).all()
+        domains = session.exec(_STMT_DOMAINS_EAGER).all()
     return templates.TemplateResponse("settings.html", {
-        "request": request, "models": models, "domains": domains, "prompts": prompts,
+        "request": request, "models": models, "domains": domains,
         "expanded_domain_id": expanded_domain_id, "prompt_type": prompt_type
     })
 
@@ -148,40 +290,47 @@ def add_model(request: Request, model_name: str = Form(...), text_output: bool =
         new_model = AIModel(name=model_name, text_output=text_output, image_output=image_output)
         session.add(new_model)
         session.commit()
-    return RedirectResponse(url="/settings", status_code=303)
+    invalidate_catalog_cache()
+    return redirect_to_settings()
 
 @app.post("/settings/delete_model/{model_id}", response_class=HTMLResponse)
 def delete_model(request: Request, model_id: int):
     with Session(engine) as session:
-        model = session.get(AIModel, model_id)
-        if not model: raise HTTPException(status_code=404, detail="AI model not found.")
-        session.delete(model)
+        # Core statements avoid hydrating the model; detach its outputs first,
+        # as the ORM would when deleting the parent
+        session.execute(update(TextOutput).where(col(TextOutput.aimodel_id) == model_id).values(aimodel_id=None))
+        session.execute(update(ImageOutput).where(col(ImageOutput.aimodel_id) == model_id).values(aimodel_id=None))
+        deleted = session.execute(delete(AIModel).where(col(AIModel.id) == model_id).returning(col(AIModel.id))).first()
+        if not deleted: raise HTTPException(status_code=404, detail="AI model not found.")
         session.commit()
-    return RedirectResponse(url="/settings", status_code=303)
+    invalidate_catalog_cache()
+    return redirect_to_settings()
 
 @app.post("/settings/add_prompt", response_class=HTMLResponse)
 def add_prompt(request: Request, prompt_text: str = Form(...), domain_id: Optional[int] = Form(None), prompt_type: str = Form(...)):
     if "{context}" not in prompt_text:
         prompt_text += " Consider the following user-provided context to seed your response: {context}"
     with Session(engine) as session:
-        new_prompt = Prompt(prompt=prompt_text, prompt_type=PromptType(prompt_type))
-        if domain_id:
-            domain = session.get(Domain, domain_id)
-            domain.prompts.append(new_prompt)
+        # Set the foreign key directly rather than loading the domain and its prompts
+        new_prompt = Prompt(prompt=prompt_text, prompt_type=_PROMPT_TYPES[prompt_type], domain_id=domain_id or None)
         session.add(new_prompt)
         session.commit()
-    return RedirectResponse(url=f"/settings?expanded_domain_id={domain_id}&prompt_type={prompt_type}", status_code=303)
+    invalidate_catalog_cache()
+    return redirect_to_settings(domain_id, prompt_type)
 
 @app.post("/settings/delete_prompt/{prompt_id}", response_class=HTMLResponse)
-def delete_prompt(request: Request, prompt_id):
+def delete_prompt(request: Request, prompt_id: int):
     with Session(engine) as session:
-        prompt = session.get(Prompt, prompt_id)
-        domain_id = prompt.domain_id
-        prompt_type = prompt.prompt_type.value
-        if not prompt: raise HTTPException(status_code=404, detail="Prompt not found.")
-        session.delete(prompt)
+        # Only the redirect target is needed, so load two columns rather than the whole prompt
+        row = session.exec(select(col(Prompt.domain_id), col(Prompt.prompt_type)).where(Prompt.id == prompt_id)).first()
+        if not row: raise HTTPException(status_code=404, detail="Prompt not found.")
+        domain_id, prompt_type = row
+        session.execute(update(TextOutput).where(col(TextOutput.prompt_id) == prompt_id).values(prompt_id=None))
+        session.execute(update(ImageOutput).where(col(ImageOutput.prompt_id) == prompt_id).values(prompt_id=None))
+        session.execute(delete(Prompt).where(col(Prompt.id) == prompt_id))
         session.commit()
-    return RedirectResponse(url=f"/settings?expanded_domain_id={domain_id}&prompt_type={prompt_type}", status_code=303)
+    invalidate_catalog_cache()
+    return redirect_to_settings(domain_id, prompt_type.value)
 
 @app.post("/settings/add_domain", response_class=HTMLResponse)
 def add_domain(request: Request, domain_name: str = Form(...)):
@@ -189,18 +338,25 @@ def add_domain(request: Request, domain_name: str = Form(...)):
         new_domain = Domain(name=domain_name)
         session.add(new_domain)
         session.commit()
-    return RedirectResponse(url="/settings", status_code=303)
+    invalidate_domains_cache()
+    return redirect_to_settings()
 
 @app.post("/settings/rewrite_prompt/{prompt_id}", response_class=HTMLResponse)
 def rewrite_existing_prompt(request: Request, prompt_id: int):
     with Session(engine) as session:
         prompt_obj = session.get(Prompt, prompt_id)
         if not prompt_obj: raise HTTPException(status_code=404, detail="Prompt not found.")
-        model = select_random_model(session)
-        if not model or not model.text_output: raise HTTPException(status_code=400, detail="No suitable text model available.")
+        try:
+            model = select_random_model(session)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="No suitable text model available.")
         rewrite_prompt(session, prompt_obj, model)
-        return RedirectResponse(url=f"/settings?expanded_domain_id={prompt_obj.domain_id}&prompt_type={prompt_obj.prompt_type.value}", status_code=303)
+        return redirect_to_settings(prompt_obj.domain_id, prompt_obj.prompt_type.value)
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=5000)
\ No newline at end of file
+    # Initialise the database before any workers start so they don't race to seed it
+    create_tables()
+    seed_db()
+    # Uvicorn uses uvloop and httptools automatically when they are installed
+    uvicorn.run("main:app", host="0.0.0.0", port=5000, workers=WEB_CONCURRENCY)
\ No newline at end of file
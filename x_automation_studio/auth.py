@@ -1,11 +1,15 @@
 # x_automation_studio/auth.py
 import os
-from dotenv import load_dotenv
+import atexit
+from functools import lru_cache
+import requests
+from requests.adapters import HTTPAdapter
 from requests_oauthlib import OAuth1
+from urllib3.util.retry import Retry
 
-# Load environment variables
-load_dotenv()
-
+# Credentials are static for the life of the process, so validate and build
+# the auth object once; OAuth1 still signs each request with a fresh nonce.
+@lru_cache(maxsize=1)
 def create_oauth1_auth() -> OAuth1:
     """Create OAuth1 authentication object for Twitter API requests."""
     required_vars = [
@@ -28,4 +32,28 @@ def create_oauth1_auth() -> OAuth1:
         client_secret=required_vars[1][1],  # X_API_SECRET
         resource_owner_key=required_vars[2][1],  # X_ACCESS_TOKEN
         resource_owner_secret=required_vars[3][1]   # X_ACCESS_TOKEN_SECRET
-    )
\ No newline at end of file
+    )
+
+# (connect, read) seconds for X API calls, so a stalled connection fails the
+# request instead of holding a worker thread indefinitely
+HTTP_TIMEOUT = (3.05, 10)
+
+# One pooled session for all X API calls, so successive posts and uploads
+# reuse open TLS connections instead of handshaking each time
+@lru_cache(maxsize=1)
+def get_http_session() -> requests.Session:
+    """Return the shared, OAuth1-signed HTTP session for the X API."""
+    session = requests.Session()
+    session.auth = create_oauth1_auth()
+    # urllib3 only retries POSTs on connection errors, so a tweet is never sent twice
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=Retry(total=3, backoff_factor=0.2))
+    session.mount("https://", adapter)
+    return session
+
+def close_http_session() -> None:
+    if get_http_session.cache_info().currsize:
+        get_http_session().close()
+        get_http_session.cache_clear()
+
+# Also close the pool on exit when the app shuts down without running lifespan
+atexit.register(close_http_session)
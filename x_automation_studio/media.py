@@ -1,22 +1,21 @@
 import logging
-import requests
-from .auth import create_oauth1_auth
+from .auth import get_http_session, HTTP_TIMEOUT
 
 logger = logging.getLogger("uvicorn.error")
 
+MEDIA_UPLOAD_URL = "https://upload.twitter.com/1.1/media/upload.json"
+
 def create_media_payload(path: str | None) -> dict[str, dict[str, list[str]]]:
     """Upload media using OAuth1 authentication and return a payload containing the media ID."""
     if not path:
         return {"media": {"media_ids": []}}
         
-    auth = create_oauth1_auth()
-    upload_url = "https://upload.twitter.com/1.1/media/upload.json"
-    
+    session = get_http_session()
     try:
         with open(path, "rb") as file:
             files = {"media": file}
-            logger.info(f"Uploading media to {upload_url}")
-            response = requests.post(upload_url, auth=auth, files=files)
+            logger.info("Uploading media to %s", MEDIA_UPLOAD_URL)
+            response = session.post(MEDIA_UPLOAD_URL, files=files, timeout=HTTP_TIMEOUT)
             response.raise_for_status()
             media_id = response.json().get("media_id_string")
             if media_id:
@@ -1,13 +1,44 @@
 # models.py
+import os
 import sqlmodel
-from sqlmodel import Session, select, SQLModel
+from sqlalchemy import event
+from sqlmodel import Session, select, exists, insert, SQLModel
 from typing import Optional
 from enum import Enum
 
 # --- DB ---
 
 DATABASE_URL = "sqlite:///./database.db"
-engine = sqlmodel.create_engine(DATABASE_URL, echo=True)
+# Size the pool to cover the request threadpool (40 threads by default) plus
+# background tasks, so concurrent requests don't queue for a connection.
+# Pre-ping and recycling are left off: a local SQLite file never drops
+# connections, so they would only add a round trip per checkout.
+# Statement logging is opt-in via SQL_ECHO=1.
+engine = sqlmodel.create_engine(
+    DATABASE_URL,
+    echo=os.getenv("SQL_ECHO") == "1",
+    pool_size=20,
+    max_overflow=40
+)
+
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    """Tune each new SQLite connection: WAL lets reads proceed during writes,
+    and NORMAL sync only fsyncs at checkpoints."""
+    if engine.dialect.name != "sqlite":
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    # The page cache is per connection and the pool can hold 60, so keep it
+    # modest (4 MB); the shared memory map below serves most reads anyway
+    cursor.execute("PRAGMA cache_size=-4000")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    # Read pages through a 256 MB memory map instead of read() syscalls
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
 
 # --- MODELS ---
 
@@ -37,7 +68,7 @@ class Prompt(sqlmodel.SQLModel, table=True):
     prompt: str
     prompt_type: PromptType
 
-    domain_id: Optional[int] = sqlmodel.Field(default=None, foreign_key="domain.id")
+    domain_id: Optional[int] = sqlmodel.Field(default=None, foreign_key="domain.id", index=True)
     domain: Optional[Domain] = sqlmodel.Relationship(back_populates="prompts")
 
     textoutputs: list["TextOutput"] = sqlmodel.Relationship(back_populates="prompt")
@@ -48,10 +79,10 @@ class TextOutput(sqlmodel.SQLModel, table=True):
     # Full text of the output
     text: str
 
-    prompt_id: Optional[int] = sqlmodel.Field(default=None, foreign_key="prompt.id")
+    prompt_id: Optional[int] = sqlmodel.Field(default=None, foreign_key="prompt.id", index=True)
     prompt: Prompt = sqlmodel.Relationship(back_populates="textoutputs")
 
-    aimodel_id: Optional[int] = sqlmodel.Field(default=None, foreign_key="aimodel.id")
+    aimodel_id: Optional[int] = sqlmodel.Field(default=None, foreign_key="aimodel.id", index=True)
     aimodel: AIModel = sqlmodel.Relationship(back_populates="textoutputs")
 
     feedback: list["Feedback"] = sqlmodel.Relationship(back_populates="textoutput")
@@ -61,10 +92,10 @@ class ImageOutput(sqlmodel.SQLModel, table=True):
     # Blob of the image
     image: bytes
 
-    prompt_id: Optional[int] = sqlmodel.Field(default=None, foreign_key="prompt.id")
+    prompt_id: Optional[int] = sqlmodel.Field(default=None, foreign_key="prompt.id", index=True)
     prompt: Prompt = sqlmodel.Relationship(back_populates="imageoutputs")
 
-    aimodel_id: Optional[int] = sqlmodel.Field(default=None, foreign_key="aimodel.id")
+    aimodel_id: Optional[int] = sqlmodel.Field(default=None, foreign_key="aimodel.id", index=True)
     aimodel: AIModel = sqlmodel.Relationship(back_populates="imageoutputs")
 
     feedback: list["Feedback"] = sqlmodel.Relationship(back_populates="imageoutput")
@@ -75,10 +106,10 @@ class Feedback(sqlmodel.SQLModel, table=True):
     score: int
     comment: Optional[str] = sqlmodel.Field(default=None)
 
-    textoutput_id: Optional[int] = sqlmodel.Field(default=None, foreign_key="textoutput.id")
+    textoutput_id: Optional[int] = sqlmodel.Field(default=None, foreign_key="textoutput.id", index=True)
     textoutput: TextOutput = sqlmodel.Relationship(back_populates="feedback")
 
-    imageoutput_id: Optional[int] = sqlmodel.Field(default=None, foreign_key="imageoutput.id")
+    imageoutput_id: Optional[int] = sqlmodel.Field(default=None, foreign_key="imageoutput.id", index=True)
     imageoutput: ImageOutput = sqlmodel.Relationship(back_populates="feedback")
 
 # --- SEED ---
@@ -100,21 +131,37 @@ DEFAULT_PROMPTS = [
 ]
 
 def create_tables():
-    SQLModel.metadata.create_all(engine)
+    # All DDL runs in one transaction, so first start-up commits once
+    with engine.begin() as connection:
+        SQLModel.metadata.create_all(connection)
+        # create_all skips tables that already exist, so add any indexes that
+        # databases created before the index was declared are still missing
+        for table in SQLModel.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
 
 
 def seed_db():
     with Session(engine) as session:
-        existing_models = session.exec(select(AIModel)).first()
-        if not existing_models:
-            for model in DEFAULT_MODELS:
-                session.add(model)
-            session.commit()
-
-        existing_domains = session.exec(select(Domain)).first()
-        if not existing_domains:
+        # EXISTS stops at the first row and doesn't hydrate an ORM object
+        has_models = session.exec(select(exists().select_from(AIModel))).one()
+        has_domains = session.exec(select(exists().select_from(Domain))).one()
+        if has_models and has_domains:
+            return
+
+        # Core multi-row inserts let the driver executemany instead of
+        # flushing one ORM object at a time
+        if not has_models:
+            session.execute(insert(AIModel), [model.model_dump(exclude={"id"}) for model in DEFAULT_MODELS])
+
+        if not has_domains:
             for domain in DEFAULT_DOMAINS:
-                for prompt in DEFAULT_PROMPTS:
-                    domain.prompts.append(prompt)
-                session.add(domain)
-            session.commit()
+                domain_id = session.execute(
+                    insert(Domain).values(name=domain.name).returning(Domain.id)
+                ).scalar_one()
+                session.execute(
+                    insert(Prompt),
+                    [{**prompt.model_dump(exclude={"id"}), "domain_id": domain_id} for prompt in DEFAULT_PROMPTS]
+                )
+        # One commit for the whole seed
+        session.commit()
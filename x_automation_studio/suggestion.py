@@ -1,16 +1,17 @@
 import re
 import logging
 import random
+import sys
+import time
 import math
 from enum import Enum
-from typing import Optional, List, TypeVar
-from dotenv import load_dotenv
+from functools import lru_cache
+from typing import Optional, Iterable, TypeVar
 from litellm import completion, ModelResponse
-from sqlmodel import Session, select, func
+from sqlmodel import Session, select, func, col
+from sqlmodel.sql.expression import SelectOfScalar
 from .models import Prompt, TextOutput, AIModel, engine, Feedback, PromptType
 
-load_dotenv(override=True)
-
 logger: logging.Logger = logging.getLogger("uvicorn.error")
 logger.setLevel(logging.INFO)
 
@@ -21,16 +22,73 @@ class Mode(Enum):
 
 T = TypeVar('T')
 
-def softmax(weights: List[float], temperature: float = 1.0) -> List[float]:
-    """Compute the softmax probability distribution for a list of weights."""
-    exps = [math.exp(w / temperature) for w in weights]
-    total = sum(exps)
-    return [exp_val / total for exp_val in exps]
-
-def weighted_random_choice(items: List[T], probabilities: List[float]) -> T:
-    """Return a randomly selected item from items using the given probabilities."""
-    # Using random.choices which accepts a weights argument:
-    return random.choices(items, weights=probabilities, k=1)[0]
+# Stating the limit up front as a system message means the first draft
+# usually fits, and each abbreviation round costs a full model call
+TWEET_SYSTEM_MESSAGE = (
+    "Hard limit: the tweet must be 280 characters or fewer. "
+    "Stop as soon as the tweet is complete."
+)
+MAX_ABBREVIATIONS = 1
+
+# X weighs tweets rather than counting characters: code points in these
+# ranges (Latin, Greek, Cyrillic, general punctuation, ...) count 1 and all
+# others, such as CJK and emoji, count 2, against a limit of 280
+TWEET_MAX_WEIGHT = 280
+_LIGHT_RANGES = ((0, 4351), (8192, 8205), (8208, 8223), (8242, 8247))
+
+# Applied to every model response, so compile them once
+_THINKING_RE = re.compile(r"<thinking>.*?</thinking>", re.DOTALL)
+_QUOTED_RE = re.compile(r'"([^"]+)"')
+# Everything up to the last whitespace that follows a non-space character
+_LAST_WORD_BREAK_RE = re.compile(r"(.*\S)\s", re.DOTALL)
+# Line breaks would split a markdown table row; translate maps both kinds
+# in one pass over the string
+_NL_TABLE = str.maketrans({"\n": " ", "\r": " "})
+
+# Statements reused on every suggestion, built once at import. Prompt
+# queries add their domain and type filters per call; the model queries
+# are complete as they stand.
+_FEEDBACK_SCORE = func.coalesce(func.sum(Feedback.score), 0)
+_STMT_PROMPT_IDS = select(col(Prompt.id))
+# Each prompt or model with its total feedback score in one grouped query.
+# Outer joins keep rows without outputs or feedback in the running at 0.
+_STMT_PROMPT_SCORES = (
+    select(Prompt, _FEEDBACK_SCORE)
+    .outerjoin(TextOutput, col(TextOutput.prompt_id) == Prompt.id)
+    .outerjoin(Feedback, col(Feedback.textoutput_id) == TextOutput.id)
+)
+_STMT_TEXT_MODEL_IDS = select(col(AIModel.id)).where(AIModel.text_output)
+_STMT_MODEL_SCORES = (
+    select(AIModel, _FEEDBACK_SCORE)
+    .outerjoin(TextOutput, col(TextOutput.aimodel_id) == AIModel.id)
+    .outerjoin(Feedback, col(Feedback.textoutput_id) == TextOutput.id)
+    .where(AIModel.text_output)
+    .group_by(col(AIModel.id))
+)
+_STMT_HIGHEST_MODEL = _STMT_MODEL_SCORES.order_by(_FEEDBACK_SCORE.desc()).limit(1)
+# Rows fetched per round trip when the weighted selectors stream scores
+CATALOG_BATCH_SIZE = 512
+
+# Prompts and models are edited by hand on the settings page, so the random
+# selectors keep their candidate ids in a short-lived in-process cache.
+# Scores are never cached; the weighted and highest modes always query them.
+CATALOG_TTL = 60
+_catalog_cache: dict[tuple, tuple[float, list[int]]] = {}
+
+def sample_softmax(rows: Iterable[tuple[T, int]], temperature: float = 1.0) -> Optional[T]:
+    """Draw an item from softmax(scores, temperature) over (item, score) rows
+    using the Gumbel-max trick. Single pass, so rows can be streamed."""
+    best_item, best_key = None, -math.inf
+    for item, score in rows:
+        key = score / temperature + gumbel_noise()
+        if key > best_key:
+            best_item, best_key = item, key
+    return best_item
+
+def gumbel_noise() -> float:
+    # random() may return 0.0, which log() rejects; it never returns 1.0
+    u = max(random.random(), sys.float_info.min)
+    return -math.log(-math.log(u))
 
 def select_weighted_prompt(
         session: Session,
@@ -39,58 +97,27 @@ def select_weighted_prompt(
         prompt_type: PromptType = PromptType.TEXT
     ) -> Prompt:
     # Optionally filter by domain
-    query = select(Prompt)
+    query = _STMT_PROMPT_SCORES
     if domain_id:
         query = query.where(Prompt.domain_id == int(domain_id))
     query = query.where(Prompt.prompt_type == prompt_type)
 
-    prompts = session.exec(query).all()
-    if not prompts:
+    # Stream the rows in batches and sample a prompt from the softmax of the
+    # scores as they arrive, so a large catalog is never held in memory
+    query = query.group_by(col(Prompt.id)).execution_options(yield_per=CATALOG_BATCH_SIZE)
+    prompt = sample_softmax(session.exec(query), temperature)
+    if prompt is None:
         raise ValueError("No prompts available for the specified domain")
-
-    scores = []
-    for prompt in prompts:
-        score = session.exec(
-            select(func.sum(func.coalesce(TextOutput.feedback.score, 0)))
-            .where(TextOutput.prompt_id == prompt.id)
-        ).one() or 0
-        scores.append(score)
-
-    # Shift scores if necessary (if there are negatives)
-    min_score = min(scores)
-    if min_score < 0:
-        scores = [s - min_score for s in scores]
-
-    # Convert scores to probabilities (using softmax here)
-    probabilities = softmax(scores, temperature=temperature)
-    
-    # Choose a prompt using the weighted random choice:
-    return weighted_random_choice(prompts, probabilities)
+    return prompt
 
 
 def select_weighted_model(session: Session, temperature: float = 1.0) -> AIModel:
-    # Retrieve all models that support text output.
-    models = session.exec(
-        select(AIModel).where(AIModel.text_output)
-    ).all()
-    if not models:
+    # Retrieve all models that support text output, with their scores.
+    query = _STMT_MODEL_SCORES.execution_options(yield_per=CATALOG_BATCH_SIZE)
+    model = sample_softmax(session.exec(query), temperature)
+    if model is None:
         raise ValueError("No models available")
-
-    scores = []
-    for model in models:
-        score = session.exec(
-            select(func.sum(func.coalesce(TextOutput.feedback.score, 0)))
-            .where(TextOutput.aimodel_id == model.id)
-        ).one() or 0
-        scores.append(score)
-    
-    min_score = min(scores)
-    if min_score < 0:
-        scores = [s - min_score for s in scores]
-
-    probabilities = softmax(scores, temperature=temperature)
-    
-    return weighted_random_choice(models, probabilities)
+    return model
 
 
 def select_highest_rated_prompt(
@@ -106,16 +133,49 @@ def select_highest_rated_prompt(
     Returns:
         Prompt: The prompt with the highest cumulative score.
     """
-    query = select(Prompt)
+    query = _STMT_PROMPT_SCORES
     if domain_id:
         query = query.where(Prompt.domain_id == int(domain_id))
     query = query.where(Prompt.prompt_type == prompt_type)
 
-    return session.exec(
-        query.order_by(
-            func.sum(func.coalesce(TextOutput.feedback.score, 0)).desc()
-        )
+    row = session.exec(
+        query.group_by(col(Prompt.id))
+        .order_by(_FEEDBACK_SCORE.desc())
+        .limit(1)
     ).first()
+    if row is None:
+        raise ValueError("No prompts available for the specified domain")
+    return row[0]
+
+
+def get_catalog_ids(session: Session, key: tuple, id_query: SelectOfScalar[Optional[int]]) -> list[int]:
+    """Return the ids matched by id_query, from the catalog cache while fresh."""
+    now = time.monotonic()
+    entry = _catalog_cache.get(key)
+    if entry is None or now - entry[0] >= CATALOG_TTL:
+        entry = (now, [row_id for row_id in session.exec(id_query).all() if row_id is not None])
+        _catalog_cache[key] = entry
+    return entry[1]
+
+
+def invalidate_catalog_cache() -> None:
+    _catalog_cache.clear()
+
+
+def pick_random_row(session: Session, model: type[T], key: tuple, id_query: SelectOfScalar[Optional[int]]) -> Optional[T]:
+    """Load a uniformly random row among the cached candidate ids, or return
+    None if there are none."""
+    # A second pass covers a row deleted since its id was cached, for
+    # example by another worker
+    for _ in range(2):
+        ids = get_catalog_ids(session, key, id_query)
+        if not ids:
+            return None
+        row = session.get(model, random.choice(ids))
+        if row is not None:
+            return row
+        _catalog_cache.pop(key, None)
+    return None
 
 
 def select_random_prompt(
@@ -131,12 +191,16 @@ def select_random_prompt(
     Returns:
         Prompt: A randomly selected prompt.
     """
-    query = select(Prompt)
+    query = _STMT_PROMPT_IDS
     if domain_id:
         query = query.where(Prompt.domain_id == int(domain_id))
     query = query.where(Prompt.prompt_type == prompt_type)
 
-    return session.exec(query.order_by(func.random())).first()
+    key = ("prompt", prompt_type, int(domain_id) if domain_id else None)
+    prompt = pick_random_row(session, Prompt, key, query)
+    if prompt is None:
+        raise ValueError("No prompts available for the specified domain")
+    return prompt
 
 
 def select_random_model(session: Session) -> AIModel:
@@ -148,11 +212,10 @@ def select_random_model(session: Session) -> AIModel:
     Returns:
         AIModel: A randomly selected AI model.
     """
-    return session.exec(
-        select(AIModel).where(
-            AIModel.text_output
-        ).order_by(func.random())
-    ).first()
+    model = pick_random_row(session, AIModel, ("text_model",), _STMT_TEXT_MODEL_IDS)
+    if model is None:
+        raise ValueError("No models available")
+    return model
 
 
 def select_highest_rated_model(session: Session) -> AIModel:
@@ -164,11 +227,10 @@ def select_highest_rated_model(session: Session) -> AIModel:
     Returns:
         AIModel: The AI model with the highest cumulative score.
     """
-    return session.exec(
-        select(AIModel).where(AIModel.text_output).order_by(
-            func.sum(func.coalesce(TextOutput.feedback.score, 0)).desc()
-        )
-    ).first()
+    row = session.exec(_STMT_HIGHEST_MODEL).first()
+    if row is None:
+        raise ValueError("No models available")
+    return row[0]
 
 
 def get_random_noun() -> str:
@@ -178,35 +240,65 @@ def get_random_noun() -> str:
     Returns:
         str: A random noun or an empty string if wonderwords is not installed.
     """
+    random_word = get_random_word_generator()
+    if random_word is None:
+        return ""
+    return random_word.word(include_parts_of_speech=["nouns"])
+
+
+# RandomWord loads its word lists from disk when constructed, so build it once
+@lru_cache(maxsize=1)
+def get_random_word_generator():
     try:
         import wonderwords
-        return wonderwords.RandomWord().word(include_parts_of_speech=["nouns"])
     except ImportError:
-        return ""
+        return None
+    return wonderwords.RandomWord()
 
 
-def call_model(model: AIModel, prompt: str) -> str:
+def call_model(model: AIModel, prompt: str, system: Optional[str] = None) -> str:
     """Call the AI model with the provided prompt and return its response.
 
     Args:
         model (AIModel): The AI model to use.
         prompt (str): The prompt to send to the model.
+        system (Optional[str]): An optional system message sent before the prompt.
 
     Returns:
         str: The generated text from the model.
     """
-    logger.info(f"Calling model: {model.name}")
-    logger.info(f"Prompt: {prompt}")
+    # Prompts and responses can run to several KB, so only format them
+    # when INFO is actually emitted
+    log_info = logger.isEnabledFor(logging.INFO)
+    if log_info:
+        logger.info("Calling model: %s", model.name)
+        logger.info("Prompt: %s", prompt)
+    messages = [{"role": "user", "content": prompt}]
+    if system:
+        messages.insert(0, {"role": "system", "content": system})
     response: ModelResponse = completion(
         model=model.name,
-        messages=[{"role": "user", "content": prompt}],
+        messages=messages,
         max_tokens=200,
         num_retries=3
     )
-    logger.info(f"Response: {str(response)}")
+    if log_info:
+        logger.info("Response: %s", response)
     return response.choices[0].message.content
 
 
+def build_output(suggestion: dict, feedback: Optional[dict] = None) -> TextOutput:
+    """Build an unsaved TextOutput, attaching the feedback if given."""
+    output = TextOutput(
+        text=suggestion["text"],
+        prompt_id=suggestion["prompt_id"],
+        aimodel_id=suggestion["aimodel_id"]
+    )
+    if feedback:
+        output.feedback.append(Feedback(**feedback))
+    return output
+
+
 def create_output_record(
         suggestion: dict, feedback: Optional[dict] = None
     ) -> int:
@@ -214,24 +306,58 @@ def create_output_record(
     Create an TextOutput record in the database. This function is intended to be
     used as a background task.
     """
-    # Import Session and engine if needed:
     with Session(engine) as session:
-        output = TextOutput(
-            text=suggestion["text"],
-            prompt_id=suggestion["prompt_id"],
-            aimodel_id=suggestion["aimodel_id"]
-        )
-        if feedback:
-            output.feedback.append(Feedback(**feedback))
+        output = build_output(suggestion, feedback)
         session.add(output)
+        # Read the id after flush; after commit it would be expired and reloaded
+        session.flush()
+        output_id = output.id
+        session.commit()
+        return output_id
+
+
+def create_output_records(records: list[tuple[dict, Optional[dict]]]) -> None:
+    """Create several TextOutput records, each with optional feedback, in one commit."""
+    with Session(engine) as session:
+        session.add_all([build_output(suggestion, feedback) for suggestion, feedback in records])
         session.commit()
-        return output.id
+
+
+def char_weight(char: str) -> int:
+    code = ord(char)
+    # Most text sits in the first range, so test it before the rest
+    if code <= 4351 or any(low <= code <= high for low, high in _LIGHT_RANGES):
+        return 1
+    return 2
+
+
+def tweet_weight(text: str) -> int:
+    """Return the length of text as X counts it toward the 280 limit."""
+    return sum(map(char_weight, text))
+
+
+def trim_to_weight(text: str, limit: int = TWEET_MAX_WEIGHT) -> str:
+    """Cut text to at most `limit` by X's weighted count, at the last word
+    break that fits when there is one."""
+    weight = 0
+    for index, char in enumerate(text):
+        weight += char_weight(char)
+        if weight > limit:
+            cut = text[:index]
+            match = _LAST_WORD_BREAK_RE.match(cut)
+            return match.group(1) if match else cut
+    return text
+
+
+def tweet_too_long(text: str) -> bool:
+    # No character weighs more than 2, so short texts can skip the scan
+    return len(text) > TWEET_MAX_WEIGHT // 2 and tweet_weight(text) > TWEET_MAX_WEIGHT
 
 
 def remove_thinking_tags(text: str) -> str:
     """Remove thinking tags from the text, even if the content spans multiple
     lines."""
-    return re.sub(r"<thinking>.*?</thinking>", "", text, flags=re.DOTALL)
+    return _THINKING_RE.sub("", text)
 
 
 def get_suggestion(context: str = "", mode: Mode = Mode.WEIGHTED, domain_id: int | str = "") -> dict:
@@ -260,7 +386,8 @@ def get_suggestion(context: str = "", mode: Mode = Mode.WEIGHTED, domain_id: int
         "steps, you may enclose it in <thinking> tags to facilitate its "
         "removal before the tweet is posted. But remember: if you do "
         "use <thinking> tags, the final tweet text must go *outside* them. "
-        + prompt
+        + prompt,
+        system=TWEET_SYSTEM_MESSAGE
     )
     logger.info(f"Initial tweet: {raw_suggestion_text}")
     if raw_suggestion_text:
@@ -282,7 +409,7 @@ def get_suggestion(context: str = "", mode: Mode = Mode.WEIGHTED, domain_id: int
 
         # As a last resort, try to extract text within quotation marks.
         if not suggestion_text:
-            match = re.search(r'"([^"]+)"', raw_suggestion_text)
+            match = _QUOTED_RE.search(raw_suggestion_text)
             if match:
                 suggestion_text = match.group(1).strip()
                 logger.info(f"Tweet after regex extraction: {suggestion_text}")
@@ -306,30 +433,46 @@ def get_suggestion(context: str = "", mode: Mode = Mode.WEIGHTED, domain_id: int
         )
         raise ValueError("Model response was empty or tweet text could not be extracted.")
 
-    # If the suggestion is too long, abbreviate it
-    while len(suggestion_text) > 280:
-        logger.info(f"Abbreviating tweet: {suggestion_text}")
-        create_output_record(
-            {
-                "text": suggestion_text,
-                "prompt_id": prompt_obj.id,
-                "aimodel_id": model.id
-            },
-            {
-                "score": -1,
-                "comment": (
-                    "TextOutput should be a single tweet, <=280 characters with "
-                    "no other text, but exceeded that limit."
-                )
-            }
-        )
-        suggestion_text = call_model(
-            model,
-            "Abbreviate this draft tweet to 280 characters or less. Only "
-            "return a single abbreviated tweet, no other text. " + 
-            suggestion_text
-        )
-        suggestion_text = remove_thinking_tags(suggestion_text)
+    # If the suggestion is too long, abbreviate it (at most MAX_ABBREVIATIONS
+    # times, then trim the last draft to fit). Penalized drafts are
+    # collected and written in one commit once the loop ends, even if a
+    # model call fails part-way through.
+    rejected: list[tuple[dict, Optional[dict]]] = []
+    abbreviations = 0
+    try:
+        while tweet_too_long(suggestion_text):
+            logger.info(f"Abbreviating tweet: {suggestion_text}")
+            rejected.append((
+                {
+                    "text": suggestion_text,
+                    "prompt_id": prompt_obj.id,
+                    "aimodel_id": model.id
+                },
+                {
+                    "score": -1,
+                    "comment": (
+                        "TextOutput should be a single tweet, <=280 characters with "
+                        "no other text, but exceeded that limit."
+                    )
+                }
+            ))
+            if abbreviations == MAX_ABBREVIATIONS:
+                # The user edits the draft before posting anyway, so hand back
+                # a trimmed draft rather than failing the suggestion
+                logger.warning("Tweet still over X's weighted limit; trimming to fit")
+                suggestion_text = trim_to_weight(suggestion_text)
+                break
+            abbreviations += 1
+            suggestion_text = call_model(
+                model,
+                "Abbreviate this draft tweet to 280 characters or less. Only "
+                "return a single abbreviated tweet, no other text. " + 
+                suggestion_text
+            )
+            suggestion_text = remove_thinking_tags(suggestion_text)
+    finally:
+        if rejected:
+            create_output_records(rejected)
 
     return {
         "text": suggestion_text,
@@ -344,30 +487,35 @@ def rewrite_prompt(session: Session, prompt: Prompt, model: AIModel) -> str:
     Replaces the original prompt with the new, rewritten version.
     Returns the newly rewritten prompt text.
     """
-    # Gather all feedback for this prompt, along with the text generated by each TextOutput.
-    feedback_items = []
-    textoutputs = session.exec(
-        select(TextOutput).where(TextOutput.prompt_id == prompt.id)
-    ).all()
-    for to in textoutputs:
-        # Typically there's just one Feedback item per output, so we needn't
-        # worry too much about redundancy of output text
-        for fb in to.feedback:
-            if fb.comment:
-                feedback_items.append({"output_text": to.text, "feedback": fb.comment})
+    # Gather all feedback comments for this prompt, along with the text
+    # generated by each TextOutput, as (text, comment) pairs in one query.
+    # Typically there's just one Feedback item per output, so we needn't
+    # worry too much about redundancy of output text.
+    feedback_items = [
+        {"output_text": output_text, "feedback": comment}
+        for output_text, comment in session.exec(
+            select(TextOutput.text, Feedback.comment)
+            .join(Feedback, col(Feedback.textoutput_id) == TextOutput.id)
+            .where(TextOutput.prompt_id == prompt.id)
+            .where(col(Feedback.comment).is_not(None))
+            .order_by(col(TextOutput.id), col(Feedback.id))
+        ).all()
+        if comment
+    ]
 
     # Build a markdown table of prior outputs and feedback (if any).
     feedback_table = ""
     if feedback_items:
+        # Collect the rows and join once rather than growing the string per row
+        rows = [
+            f"| {item['output_text'].translate(_NL_TABLE)} | {item['feedback'].translate(_NL_TABLE)} |\n"
+            for item in feedback_items
+        ]
         feedback_table = (
             "\n\nIncorporate improvements based on these prior outputs and feedback:\n\n"
             "| **Output Text** | **Feedback** |\n"
             "|-----------------|--------------|\n"
-        )
-        for item in feedback_items:
-            output_text = item["output_text"].replace("\n", " ")
-            feedback_comment = item["feedback"].replace("\n", " ")
-            feedback_table += f"| {output_text} | {feedback_comment} |\n"
+        ) + "".join(rows)
 
     # Basic rewriting instructions.
     rewrite_instructions = (
@@ -399,5 +547,6 @@ def rewrite_prompt(session: Session, prompt: Prompt, model: AIModel) -> str:
     )
     session.add(new_prompt)
     session.commit()
+    invalidate_catalog_cache()
 
     return rewritten_text
@@ -1,28 +1,99 @@
 import os
+import json
+import time
 import logging
+import threading
+import math
 import requests
-from dotenv import load_dotenv
+from functools import partial
+from anyio import to_thread
 from typing import Optional
 from .media import create_media_payload
-from .auth import create_oauth1_auth
-
-load_dotenv()
+from .auth import get_http_session, HTTP_TIMEOUT
 
 logger = logging.getLogger("uvicorn.error")
 
-def create_text_payload(text: str) -> dict[str, str]:
-    return {"text": text}
+# Resolved once; the username doesn't change while the app runs. Without it,
+# links use X's /i/status/ form, which resolves for any account.
+X_USERNAME = os.getenv("X_USERNAME", "")
+if not X_USERNAME:
+    logger.warning("X_USERNAME is not set; tweet links will use https://x.com/i/status/<id>")
+
+# Pace tweet posts to stay under X's write cap: at most 50 in a burst,
+# refilling over a 15-minute window. Each worker process has its own bucket,
+# so the cap is split evenly across WEB_CONCURRENCY workers.
+TWEET_BUCKET_CAPACITY = max(1, 50 // int(os.getenv("WEB_CONCURRENCY", "1")))
+TWEET_BUCKET_WINDOW = 15 * 60
+# Longest a post will wait for a token before giving up
+TWEET_MAX_WAIT = 30.0
+
+class TokenBucket:
+    """Thread-safe token bucket. acquire() sleeps until a token is free, and
+    block_until() holds every caller back until an API-reported reset time."""
+
+    def __init__(self, capacity: int, refill_per_sec: float):
+        self.capacity = capacity
+        self.refill_per_sec = refill_per_sec
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self, max_wait: float) -> None:
+        """Take a token, sleeping if needed. Raises RuntimeError rather than
+        wait longer than max_wait seconds."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_per_sec)
+                self.updated = now
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = max(self.blocked_until - now, (1 - self.tokens) / self.refill_per_sec)
+            if delay > max_wait:
+                raise RuntimeError(f"Tweet rate limit reached. Try again in {math.ceil(delay)} seconds.")
+            time.sleep(delay)
+
+    def block_until(self, reset_epoch: float) -> None:
+        """Hold all callers until the given Unix time and empty the bucket."""
+        with self.lock:
+            self.blocked_until = time.monotonic() + max(0.0, reset_epoch - time.time())
+            self.tokens = 0.0
+            self.updated = time.monotonic()
+
+TWEET_URL = "https://api.x.com/2/tweets"
+# Sent with every tweet post. requests copies it into each prepared request,
+# so one shared dict is safe; it isn't a session default because the media
+# upload on the same session must keep its multipart Content-Type.
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+_WRITE_BUCKET = TokenBucket(TWEET_BUCKET_CAPACITY, TWEET_BUCKET_CAPACITY / TWEET_BUCKET_WINDOW)
+
+# Fixed messages for statuses whose body detail doesn't help the user;
+# others show X's own detail instead
+STATUS_MESSAGES = {
+    429: "Rate limit exceeded. Please wait a few minutes and try again.",
+}
+
+# Error bodies can be whole HTML pages from a proxy, so only log their start
+ERROR_BODY_LOG_LIMIT = 2048
+
+def update_rate_limit(response: requests.Response) -> None:
+    """Stop posting until X's reset time once the window is used up."""
+    reset = response.headers.get("x-rate-limit-reset")
+    exhausted = response.status_code == 429 or response.headers.get("x-rate-limit-remaining") == "0"
+    if exhausted and reset and reset.isdigit():
+        _WRITE_BUCKET.block_until(int(reset))
 
 def create_tweet_payload(text: str, media_path: str | None = None) -> dict:
-    text_payload = create_text_payload(text=text)
     if media_path is None:
-        return text_payload
-    media_payload = create_media_payload(path=media_path)
-    return {**text_payload, **media_payload}
+        return {"text": text}
+    return {"text": text, **create_media_payload(path=media_path)}
 
 def construct_tweet_link(tweet_id: str) -> str:
     """Construct the tweet link from the username and tweet ID."""
-    return f"https://x.com/{os.getenv("X_USERNAME")}/status/{tweet_id}"
+    return f"https://x.com/{X_USERNAME or 'i'}/status/{tweet_id}"
 
 
 def handle_tweet_response(response: requests.Response) -> tuple[Optional[str], Optional[str]]:
@@ -37,14 +108,19 @@ def handle_tweet_response(response: requests.Response) -> tuple[Optional[str], O
         logger.info("Successfully posted tweet")
         message = "Tweet posted successfully!"
         # Extract tweet link on success
-        logger.info("Response: %s", response.json())
-        tweet_id = response.json().get("data", {}).get("id", "")
+        body = response.json()
+        # The full body is only for debugging; skip stringifying it otherwise
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Response: %s", body)
+        tweet_id = body.get("data", {}).get("id", "")
         tweet_link = construct_tweet_link(tweet_id=tweet_id)
         if tweet_link:
             logger.info("Tweet URL: %s", tweet_link)
     else:
+        # Read the body once for both parsing and logging; json.loads takes bytes
+        raw = response.content
         try:
-            error_details = response.json()
+            error_details = json.loads(raw)
             if 'errors' in error_details:
                 # Handle Twitter API specific error format
                 error_messages = [error['message'] for error in error_details['errors']]
@@ -53,20 +129,21 @@ def handle_tweet_response(response: requests.Response) -> tuple[Optional[str], O
             else:
                 # Handle general API errors
                 status_code = response.status_code
-                if status_code == 429:
-                    message = "Rate limit exceeded. Please wait a few minutes and try again."
-                    logger.error("Rate limit exceeded")
-                else:
+                message = STATUS_MESSAGES.get(status_code)
+                if message is None:
                     # Get the most meaningful error detail
                     detail = error_details.get('detail') or error_details.get('title') or response.reason
                     message = f"Error ({status_code}): {detail}"
                     logger.error("API error %d: %s", status_code, detail)
+                else:
+                    logger.error("API error %d: %s", status_code, message)
         except ValueError:
             message = f"Error ({response.status_code}): {response.reason}"
-            logger.error("Failed to parse error response: %s", response.text)
+            logger.error("Failed to parse error response: %s", raw[:ERROR_BODY_LOG_LIMIT].decode("utf-8", "replace"))
         
-        logger.error("Failed to post tweet: %s %s - %s", 
-                    response.status_code, response.reason, response.text)
+        logger.error("Failed to post tweet: %s %s", response.status_code, response.reason)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Error response body: %s", raw[:ERROR_BODY_LOG_LIMIT].decode("utf-8", "replace"))
     
     return message, tweet_link
 
@@ -75,16 +152,28 @@ def submit_tweet(text: str, media_path: str | None = None) -> requests.Response:
     Post a tweet with optional media using OAuth1 authentication.
     Returns the raw response object.
     """
+    # Wait for a token before uploading any media, so a refused post
+    # doesn't spend an upload
+    _WRITE_BUCKET.acquire(TWEET_MAX_WAIT)
     tweet_payload = create_tweet_payload(text=text, media_path=media_path)
-    logger.info(f"Posting tweet with payload: {tweet_payload}")
+    logger.info("Posting tweet with payload: %s", tweet_payload)
     
-    auth = create_oauth1_auth()
-    return requests.request(
-        method="POST",
-        url="https://api.x.com/2/tweets",
-        json=tweet_payload,
-        auth=auth,  # Use the auth parameter for OAuth1
-        headers={
-            "Content-Type": "application/json",
-        },
+    # Encode the body ourselves: compact separators and raw UTF-8 (rather than
+    # \u escapes for emoji and CJK) keep it smaller than requests' json=
+    body = json.dumps(tweet_payload, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    response = get_http_session().post(
+        url=TWEET_URL,
+        data=body,
+        headers=JSON_HEADERS,
+        timeout=HTTP_TIMEOUT,
     )
+    update_rate_limit(response)
+    return response
+
+async def submit_tweet_async(text: str, media_path: str | None = None) -> requests.Response:
+    """
+    Post a tweet from async code without blocking the event loop.
+    OAuth1 signing is tied to requests, so the shared session does the I/O on
+    a worker thread; await several of these to post tweets concurrently.
+    """
+    return await to_thread.run_sync(partial(submit_tweet, text=text, media_path=media_path))
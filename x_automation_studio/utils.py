@@ -1,27 +1,32 @@
-import os
 import tempfile
 import shutil
-import atexit
 import sqlmodel
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator
+from .models import engine
 
-# In-memory path for the temp directory
-temp_dir_path = None
+# Copy uploads in fixed-size chunks so memory use doesn't scale with file size
+UPLOAD_CHUNK_SIZE = 1 << 16
 
-def get_temp_dir() -> str:
-    global temp_dir_path
-    if not temp_dir_path:
-        temp_dir_path = tempfile.mkdtemp()
-    return temp_dir_path
+@contextmanager
+def temp_workdir() -> Iterator[str]:
+    """Yield a fresh temp directory for one request; it and its contents are
+    removed on exit, so uploads never pile up or collide across requests."""
+    with tempfile.TemporaryDirectory(prefix="xas_") as temp_dir:
+        yield temp_dir
 
-def cleanup_temp_dir() -> None:
-    global temp_dir_path
-    if temp_dir_path and os.path.exists(temp_dir_path):
-        shutil.rmtree(temp_dir_path)
-        temp_dir_path = None
+def save_upload(file: BinaryIO, path: str) -> None:
+    """Stream an uploaded file object to disk in UPLOAD_CHUNK_SIZE chunks."""
+    with open(path, "wb") as buffer:
+        shutil.copyfileobj(file, buffer, length=UPLOAD_CHUNK_SIZE)
 
-# Register cleanup function
-atexit.register(cleanup_temp_dir)
+def get_db_session() -> Iterator[sqlmodel.Session]:
+    """Yield a session on the app's engine and close it afterwards, returning
+    its connection to the pool. Usable as a FastAPI Depends dependency."""
+    # Share the app's engine, so sessions draw on its connection pool and
+    # SQLite pragmas instead of building a new engine per call
+    with sqlmodel.Session(engine) as session:
+        yield session
 
-def get_db_session() -> sqlmodel.Session:
-    engine = sqlmodel.create_engine("sqlite:///x_automation_studio.db")
-    return sqlmodel.Session(engine)
+# The same for scripts and other non-FastAPI code: `with db_session() as session:`
+db_session = contextmanager(get_db_session)